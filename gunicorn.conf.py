@@ -0,0 +1,10 @@
+import multiprocessing
+
+# Production server settings, picked up automatically by `gunicorn main:app`.
+# One worker process per core spreads the CPU-bound resizing across cores,
+# and threads within each worker let slow uploads overlap.
+bind = '0.0.0.0:5000'
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = 4
+timeout = 120
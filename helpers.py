@@ -1,32 +1,122 @@
 import boto3
+import math
+import PIL
+from botocore.config import Config
 from io import BytesIO
+from PIL import Image
 
-s3_client = boto3.client('s3')
+# pyvips is optional and only needed for the vips image backend
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+else:
+    # Uploads are untrusted, so keep libvips away from the loaders it marks
+    # as unsafe for untrusted input (librsvg, libheif, ImageMagick, ...)
+    pyvips.block_untrusted_set(True)
 
+# libvips loaders accepted by the vips backend: only formats the Pillow
+# backend decodes too, so both backends accept the same uploads
+VIPS_LOADERS = {
+    'jpegload_buffer',
+    'pngload_buffer',
+    'webpload_buffer',
+    'gifload_buffer',
+    'tiffload_buffer'
+}
 
-def resize_image(image, size):
-    # Resize the image while preserving the aspect ratio
-    image.thumbnail(size)
-    return image
+# Single S3 client shared by every helper and worker thread. The connection
+# pool is sized above the upload pool so parallel uploads never queue for a
+# connection.
+s3_client = boto3.client('s3', config=Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+))
 
+# Pillow-SIMD releases are versioned as post-releases of the Pillow version
+# they track (e.g. 9.5.0.post1)
+PIL_SIMD = 'post' in PIL.__version__
 
-def upload_image_to_s3(image, key, bucket_name):
-    # Convert the image to WebP format with lossless compression
+
+def round_aspect(number, key):
+    # Round down or up, whichever keeps the aspect ratio closer (as thumbnail())
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def resize_image(image, size, original_size=None, resample=Image.Resampling.BICUBIC):
+    # Resize the image while preserving the aspect ratio. Unlike thumbnail(),
+    # resize() returns a new image, so the source never needs to be copied.
+    # When image is an intermediate (drafted or already downscaled) copy, the
+    # target is computed from original_size so rounding never accumulates.
+    width, height = original_size or image.size
+    x, y = size
+    if x >= width and y >= height:
+        # Never upscale, matching thumbnail()
+        return image
+
+    # Same target dimensions as thumbnail()
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+
+    if (x, y) == image.size:
+        return image
+
+    return image.resize((x, y), resample, reducing_gap=3.0)
+
+
+def upload_image_to_s3(image, key, bucket_name, save_kwargs=None):
+    # Convert the image to WebP format with the given encoder settings
     image_data = BytesIO()
-    image.save(image_data, format='webp', lossless=True)
-    image_data.seek(0)
+    image.save(image_data, format='WEBP', **(save_kwargs or {}))
+
+    return upload_bytes_to_s3(image_data.getvalue(), key, bucket_name)
+
 
-    # Upload the image to S3 using the pre-created client object
-    s3_client.upload_fileobj(image_data, bucket_name, key)
-    image_data.close()
+def get_image_size_vips(image_bytes):
+    # Read the dimensions from the header; libvips does not decode the pixels
+    image = pyvips.Image.new_from_buffer(image_bytes, '')
 
+    loader = image.get('vips-loader')
+    if loader not in VIPS_LOADERS:
+        raise pyvips.Error(f'Unsupported image format: {loader}')
 
-def is_file_exists(bucket_name, key):
-    # Check if the file already exists in the bucket
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    objs = list(bucket.objects.filter(Prefix=key))
-    return len(objs) > 0
+    return image.width, image.height
+
+
+def thumbnail_vips(image_bytes, size, save_kwargs=None):
+    # Decode and resize in one step so libvips can shrink on load, never
+    # upscaling and leaving EXIF orientation alone to match resize_image.
+    # libvips fills in truncated or corrupt data by default; fail_on makes the
+    # loader raise instead, and it only reaches the loader via option_string.
+    thumbnail = pyvips.Image.thumbnail_buffer(
+        image_bytes, size[0], height=size[1], size='down', no_rotate=True,
+        option_string='fail_on=error')
+
+    # Convert to WebP, mapping Pillow's encoder settings onto libvips'
+    save_kwargs = save_kwargs or {}
+    image_data = thumbnail.write_to_buffer(
+        '.webp',
+        Q=save_kwargs.get('quality', 80),
+        effort=save_kwargs.get('method', 4),
+        lossless=save_kwargs.get('lossless', False)
+    )
+    return image_data, (thumbnail.width, thumbnail.height)
+
+
+def upload_bytes_to_s3(data, key, bucket_name):
+    # Upload already encoded bytes to S3 in a single PUT and return the size
+    # of the stored object, so callers don't need a HEAD request for it
+    s3_client.put_object(Bucket=bucket_name, Key=key, Body=data)
+    return len(data)
+
+
+def get_existing_keys(bucket_name, prefix):
+    # List the keys already stored under a prefix in a single request
+    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+    return {obj['Key'] for obj in response.get('Contents', [])}
 
 
 def format_file_size(file_size):
@@ -38,15 +128,3 @@ def format_file_size(file_size):
         file_size = f'{file_size / 1024:.2f} KB'
 
     return file_size
-
-
-def get_file_size(bucket_name, key):
-    # Get the file size from S3
-    s3 = boto3.client('s3')
-    response = s3.head_object(Bucket=bucket_name, Key=key)
-    file_size = response['ContentLength']
-
-    # Format the file size
-    formatted_size = format_file_size(file_size)
-
-    return formatted_size
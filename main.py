@@ -1,27 +1,99 @@
 import os
-import boto3
+import PIL
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError, NoCredentialsError
 from flask import Flask, request, jsonify
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from io import BytesIO
-from helpers import resize_image, upload_image_to_s3, is_file_exists, get_file_size, format_file_size
+from helpers import (
+    PIL_SIMD, pyvips, s3_client,
+    resize_image, upload_image_to_s3, upload_bytes_to_s3, get_existing_keys, format_file_size,
+    get_image_size_vips, thumbnail_vips
+)
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 
+# Reject oversized uploads from the Content-Length header, before Werkzeug
+# reads and spools the body. Override with MAX_CONTENT_LENGTH (in bytes).
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 20 * 1024 * 1024))
+
+# Shared pool for the encode and upload work. Pillow releases the GIL while
+# encoding, and boto3 while waiting on S3, so threads give real parallelism
+# here without the process pools Lambda does not support. Uploads are latency
+# bound, so the pool is sized for S3 rather than for the CPU count.
+executor = ThreadPoolExecutor(max_workers=16)
+
+# Image backend: 'pillow' (default) or 'vips'. The vips backend needs pyvips
+# and libvips, and resizes straight from the uploaded bytes with shrink-on-load.
+IMAGE_BACKEND = os.environ.get('IMAGE_BACKEND', 'pillow')
+if IMAGE_BACKEND not in ('pillow', 'vips'):
+    raise RuntimeError(f"IMAGE_BACKEND must be 'pillow' or 'vips', not {IMAGE_BACKEND!r}.")
+if IMAGE_BACKEND == 'vips' and pyvips is None:
+    raise RuntimeError("IMAGE_BACKEND is 'vips' but pyvips is not installed.")
+
+# Sizes for t, s, m, l, xl and xxl, largest first so that each size can be
+# resized from the one before it
+SIZES = (
+    ('xxl', (1200, 1200)),
+    ('xl', (1000, 1000)),
+    ('l', (800, 800)),
+    ('m', (500, 500)),
+    ('s', (300, 300)),
+    ('t', (100, 100))
+)
+
+
 def bucket_exists(bucket_name):
     """
     Check if an S3 bucket exists.
     """
-    s3 = boto3.client('s3')
     try:
-        s3.head_bucket(Bucket=bucket_name)
+        s3_client.head_bucket(Bucket=bucket_name)
         return True
     except (ClientError, NoCredentialsError):
         return False
 
 
+def get_image_details(filename, size_name, size, key, bucket_name, file_size):
+    """
+    Build the response details for an uploaded image.
+    """
+    # Construct the image URL
+    image_url = f"https://{bucket_name}.s3.amazonaws.com/{key}"
+
+    return {
+        'filename': filename,
+        'size_name': size_name,
+        'size': size,
+        'file_size': format_file_size(file_size),
+        'url': image_url
+    }
+
+
+def process_size(resized_image, size_name, key, bucket_name, filename, save_kwargs):
+    """
+    Upload a single resized image to S3 and return its details.
+    """
+    file_size = upload_image_to_s3(resized_image, key, bucket_name, save_kwargs)
+    return get_image_details(filename, size_name, resized_image.size, key, bucket_name, file_size)
+
+
+def process_size_vips(image_data, resized_size, size_name, key, bucket_name, filename):
+    """
+    Upload a single libvips thumbnail to S3 and return its details.
+    """
+    file_size = upload_bytes_to_s3(image_data, key, bucket_name)
+    return get_image_details(filename, size_name, resized_size, key, bucket_name, file_size)
+
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    max_size = format_file_size(app.config['MAX_CONTENT_LENGTH'])
+    return jsonify({'error': f'Image exceeds the maximum upload size of {max_size}.'}), 413
+
+
 @app.route("/")
 def test_endpoint():
     return "PixelPushupAPI is up and running!"
@@ -36,35 +108,24 @@ def pushup():
     # Get the uploaded image from the request
     image_file = request.files['image']
 
-    # Get the file size of the original image
-    image_file.seek(0, os.SEEK_END)
-    original_file_size = format_file_size(image_file.tell())
+    # Get the WebP encoder settings from the request form
+    try:
+        quality = int(request.form.get('quality', 80))
+        method = int(request.form.get('method', 4))
+    except ValueError:
+        return jsonify({'error': 'quality and method must be integers.'}), 400
 
-    image_file.seek(0)
+    if not 1 <= quality <= 100:
+        return jsonify({'error': 'quality must be between 1 and 100.'}), 400
 
-    image = Image.open(image_file)
+    if not 0 <= method <= 6:
+        return jsonify({'error': 'method must be between 0 and 6.'}), 400
 
-    # Remove file extension from filename
-    filename = os.path.splitext(image_file.filename)[0]
+    lossless = request.form.get('lossless', 'false').lower() in ('1', 'true', 'yes')
 
-    # Get the BucketDir from the request header
-    bucket_location = request.headers.get('BucketLocation')
-
-    # Create a folder for the filename in BucketDir
-    folder_path = os.path.join(bucket_location, filename)
-
-    # Get the image size of the original image
-    original_image_size = image.size
-
-    # Define the sizes for t, s, m, l
-    sizes = {
-        't': (100, 100),
-        's': (300, 300),
-        'm': (500, 500),
-        'l': (800, 800),
-        'xl': (1000, 1000),
-        'xxl': (1200, 1200)
-    }
+    # Lossy at method 4 is libwebp's balance of speed and size; lossless is
+    # several times slower to encode. Built once and shared by every size.
+    save_kwargs = {'quality': quality, 'method': method, 'lossless': lossless}
 
     # Get the S3 bucket name from environment variables
     print("S3_BUCKET_NAME:", os.environ.get('S3_BUCKET_NAME'))
@@ -73,6 +134,75 @@ def pushup():
     if not bucket_name:
         return jsonify({'error': 'S3 bucket name not found in environment variables.'}), 500
 
+    # Get the BucketDir from the request header
+    bucket_location = request.headers.get('BucketLocation')
+    if not bucket_location:
+        return jsonify({'error': 'BucketLocation header not found in the request.'}), 400
+
+    # Split the file extension from the filename
+    filename, extension = os.path.splitext(image_file.filename)
+
+    # Create a folder for the filename in BucketDir
+    folder_path = bucket_location.rstrip('/') + '/' + filename
+
+    # Build the S3 key for every size once
+    key_prefix = folder_path + '/'
+    keys = {size_name: key_prefix + size_name + '.webp' for size_name, _ in SIZES}
+
+    # List what is already stored for this image in one request on the thread
+    # pool. The upload is read and decoded while the listing is in flight.
+    existing_keys = executor.submit(get_existing_keys, bucket_name, key_prefix)
+
+    # Read the uploaded file once; the original is stored as these exact bytes
+    image_bytes = image_file.read()
+
+    # Get the file size of the original image
+    original_file_size = format_file_size(len(image_bytes))
+
+    if IMAGE_BACKEND == 'vips':
+        try:
+            original_image_size = get_image_size_vips(image_bytes)
+
+            # Apply the same decompression bomb limit as Pillow, before
+            # libvips decodes anything
+            width, height = original_image_size
+            if Image.MAX_IMAGE_PIXELS and width * height > 2 * Image.MAX_IMAGE_PIXELS:
+                return jsonify({'error': 'Invalid image file.'}), 400
+
+            # libvips only decodes the pixels while making each thumbnail, so
+            # make all of them on the thread pool before anything is uploaded
+            # to reject malformed data up front. Each size is decoded straight
+            # from the upload so libvips can shrink on load.
+            thumbnails = list(executor.map(
+                lambda size: thumbnail_vips(image_bytes, size, save_kwargs),
+                [size for _, size in SIZES]))
+        except pyvips.Error:
+            return jsonify({'error': 'Invalid image file.'}), 400
+    else:
+        try:
+            image = Image.open(BytesIO(image_bytes))
+
+            # Get the image size of the original image
+            original_image_size = image.size
+
+            # JPEGs can be decoded at a reduced scale: let libjpeg shrink the
+            # image on load to the smallest scale still covering the largest size
+            if image.format == 'JPEG':
+                max_dim = max(SIZES[0][1])
+                image.draft('RGB', (max_dim, max_dim))
+
+            # Force the decode now so malformed data is rejected before any
+            # upload. Every size is derived from this one buffer.
+            image.load()
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+            return jsonify({'error': 'Invalid image file.'}), 400
+
+    # Fail on any clash before anything is uploaded
+    stored = existing_keys.result()
+    existing = [key for key in keys.values() if key in stored]
+    if existing:
+        return jsonify({'error': f"Files already exist in the bucket: {', '.join(existing)}"}), 400
+
     # List to store the image details
     image_details = []
 
@@ -85,38 +215,34 @@ def pushup():
     }
 
     # Upload the original image to the 'originals' folder
-    original_key = os.path.join(
-        folder_path, f'original{os.path.splitext(image_file.filename)[1]}')
-    upload_image_to_s3(image.copy(), original_key, bucket_name)
-
-    # Process and upload the resized images
-    for size_name, size in sizes.items():
-        resized_image = resize_image(image.copy(), size)
-        key = os.path.join(folder_path, f'{size_name}.webp')
-
-        # Check if the file already exists in the bucket
-        if is_file_exists(bucket_name, key):
-            return jsonify({'error': f'File {key} already exists in the bucket.'}), 400
+    original_key = key_prefix + 'original' + extension
+    original_upload = executor.submit(
+        upload_bytes_to_s3, image_bytes, original_key, bucket_name)
 
-        upload_image_to_s3(resized_image, key, bucket_name)
-
-        # Get the resized image size
-        resized_image_size = resized_image.size
-
-        # Get the file size from S3
-        file_size = get_file_size(bucket_name, key)
+    futures = []
+    if IMAGE_BACKEND == 'vips':
+        # Upload the thumbnails made above in parallel
+        for (size_name, _), (image_data, resized_size) in zip(SIZES, thumbnails):
+            futures.append(executor.submit(
+                process_size_vips, image_data, resized_size, size_name, keys[size_name],
+                bucket_name, filename))
+    else:
+        # Resize from the largest size down, each size resampled from the
+        # previous (already smaller) one but sized from the original
+        # dimensions, and upload every size in parallel as it's ready
+        resized_image = image
+        for size_name, size in SIZES:
+            resized_image = resize_image(resized_image, size, original_image_size)
+            futures.append(executor.submit(
+                process_size, resized_image, size_name, keys[size_name], bucket_name, filename,
+                save_kwargs))
 
-        # Construct the image URL
-        image_url = f"https://{bucket_name}.s3.amazonaws.com/{key}"
+    # Add image details to the list, smallest size first
+    for future in reversed(futures):
+        image_details.append(future.result())
 
-        # Add image details to the list
-        image_details.append({
-            'filename': filename,
-            'size_name': size_name,
-            'size': resized_image_size,
-            'file_size': file_size,
-            'url': image_url
-        })
+    # Surface any error from the original upload
+    original_upload.result()
 
     # Prepare the response
     response = {
@@ -129,6 +255,7 @@ def pushup():
 
 
 if __name__ == '__main__':
+    print(f" * Pillow {PIL.__version__} (SIMD: {'yes' if PIL_SIMD else 'no'})")
     bucket_name = os.environ.get('S3_BUCKET_NAME')
     if bucket_name:
         if bucket_exists(bucket_name):